@@ -1,10 +1,10 @@
 import numpy as np
-import pickle as pkl
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pymef.mef_session import MefSession
 
 from utils import *
-from montage import define_pairs
+from montage import define_pairs, bipolar_indices
 
 # mef_file = 'C:/Users/vojta/PycharmProjects/ICRC/HFO/data/mni_00583_01.mefd'
 # password = 'mnimef'
@@ -17,6 +17,8 @@ password = 'bemena'
 
 window = 30
 overlap = 1.25
+# epochs read from MEF at once, memory of two blocks is needed at a time
+epochs_per_read = 4
 
 # loading mef session
 ms = MefSession(mef_file, password)
@@ -50,96 +52,54 @@ nfeat = 24
 ne = 0
 nf = 1
 nnf = 1
-sleep_stage = np.zeros((1500, 5))
-night = np.ones((1500, 1), dtype=bool)
+sleep_stage = np.zeros((epochs, 5))
+night = np.ones((epochs, 1), dtype=bool)
 sleep_stage[ne:epochs, 0:2] = np.array((np.ones(epochs) * nf, start_time + np.arange(0, epochs) / 2880), dtype=int).T
 
 bi_pairs, bi_names = define_pairs(uni_names)
+bi_pairs_idx = bipolar_indices(uni_names, bi_pairs)
 num_channels = len(bi_names)
-feature = np.zeros((nfeat, len(bi_names), 1500))
+# features are written straight to the output file, only the pages being touched stay in memory
+feature = np.lib.format.open_memmap('sleep_features.npy', mode='w+', dtype=np.float32,
+                                    shape=(num_channels, nfeat, epochs))
 
 print('Computing features...')
 
-for ii in range(0, epochs):
-    bi_data = read_signal(ms, start_time + ii * window * 1e6, window, overlap, uni_names, bi_pairs)
-    bi_data = change_sampling_rate(bi_data, fs)
+# read the next block of epochs in background while the current one is being processed
+with ThreadPoolExecutor(max_workers=1) as executor:
+    next_read = executor.submit(read_signal, ms, start_time, window, overlap, uni_names, bi_pairs_idx, fs,
+                                min(epochs_per_read, epochs))
 
-    bi_data = bi_data[63:, :]
-    bi_data = bi_data[:8192, :]
-    bi_data = bi_data - np.tile(np.mean(bi_data), (8192, 1))
+    for ii in range(0, epochs):
+        if ii % epochs_per_read == 0:
+            block = next_read.result()
+            next_block = ii + epochs_per_read
+            if next_block < epochs:
+                next_read = executor.submit(read_signal, ms, start_time + next_block * window * 1e6, window, overlap,
+                                            uni_names, bi_pairs_idx, fs, min(epochs_per_read, epochs - next_block))
 
-    for i in range(bi_data.shape[1]):
-        feature[:, i, ne] = compute_features(bi_data[:, i])
+        bi_data = change_sampling_rate(block[ii % epochs_per_read], fs)
 
-    night[ne] = nf <= nnf
-    sleep_stage[ne, 4] = sta + 30 * fs * ii
+        bi_data = bi_data[63:, :]
+        bi_data = bi_data[:8192, :]
+        bi_data -= np.mean(bi_data)
 
-    ne += 1
+        feature[:, :, ne] = compute_epoch_features(bi_data).T
 
-    print('Epoch: ', ii + 1)
+        night[ne] = nf <= nnf
+        sleep_stage[ne, 4] = sta + 30 * fs * ii
 
-print('Computing features done!')
+        ne += 1
 
-ne += 1
-num_feats = 24
+        print('Epoch: ', ii + 1)
 
-feature = feature[:, :, 0:ne]
-night = night[0:ne]
-feature = feature.transpose((1, 2, 0))
-sleep_stage = sleep_stage[0:ne, :]
+print('Computing features done!')
 
 # preprocess features
 print('Preprocessing features...')
 
-x, y = np.where(np.sum(np.isnan(feature) | np.isinf(feature), axis=2) > 0)
-
-for ii in range(len(x)):
-    feature[x[ii], y[ii], :] = np.nan
-
-featfeat = np.zeros((num_feats, num_channels))
-
-for nch in range(0, num_channels):
-    for nf in range(0, num_feats):
-        # outlier detection
-        f = feature[nch, :, nf]
-        in_nan = np.isnan(f)
-        f_nan_removed = f[~in_nan]
-        f_nan_removed = f_nan_removed - (np.convolve(f_nan_removed, np.ones(10), mode='same') / 10)
-
-        fsort = np.sort(f_nan_removed)
-        m = fsort[[round(0.25 * len(fsort)), round(0.75 * len(fsort))]]
-        del_nan = np.isnan(feature[nch, :, nf])
-        del_nan[~in_nan] = (f_nan_removed < m[0] - 2.5 * (m[1] - m[0])) | (
-                f_nan_removed > m[1] + 2.5 * (m[1] - m[0])) | np.isnan(f_nan_removed)
-
-        feature[nch, del_nan, nf] = np.nan
-
-        # smoothing
-        f = feature[nch, :, nf]
-        ff = f.copy()
-        in_nan = np.isnan(ff)
-        ff = ff[~in_nan]
-        ff = np.convolve(ff, np.ones(3), mode='same') / 3
-        f[~in_nan] = ff
-
-        # normalizing
-        if np.any(f):
-            night = night.astype(bool)
-            f = (f - np.nanmean(f[night[:, 0]])) / np.nanstd(f[night[:, 0]])
-
-        # get features coordinates
-        feature[nch, :, nf] = f
-        in_nan = np.isnan(f)
-        f = f[~in_nan]
-        fm = np.convolve(f, np.ones(10), 'same') / 10
-        f = np.linalg.norm(f)
-
-        if f:
-            featfeat[nf, nch] = np.linalg.norm(fm) / np.linalg.norm(f)
-
-featfeat = featfeat.T
+featfeat = preprocess_features(feature, night)
 
-print('Saving features to pickle...')
+print('Saving features...')
 
-with open('sleep_features.pkl', 'wb') as f:
-    pkl.dump(feature, f)
+feature.flush()
@@ -1,5 +1,11 @@
+import re
 import numpy as np
 
+_NOT_DIGITS = re.compile(r'\D')
+_NOT_BASE = re.compile(r"[^\w']|[\d_]")
+_SINGLE_DIGIT = re.compile(r'(\D*)(\d\D*)\Z')
+_LEADING_ZERO = re.compile(r'(\D*)0')
+
 
 def __indices(lst, element):
     """
@@ -85,23 +91,15 @@ def channel_sort_list(channels):
     # rename unipolar channels and add 0s - for good ordering
     modified_channels = []
     for channel in channels:
-        digits = [x for x in channel if x.isdigit()]
-        if len(digits) == 1:
-            dig_idx = channel.index(digits[0])
-            mod_chan = channel[:dig_idx] + '0' + channel[dig_idx:]
-            modified_channels.append(mod_chan)
-        else:
-            modified_channels.append(channel)
+        single = _SINGLE_DIGIT.match(channel)
+        modified_channels.append(single[1] + '0' + single[2] if single else channel)
 
     modified_channels.sort()
 
     for ci, channel in enumerate(modified_channels):
-        digits = [x for x in channel if x.isdigit()]
-        if not len(digits):
-            continue
-        if digits[0] == '0':
-            dig_idx = channel.index(digits[0])
-            modified_channels[ci] = modified_channels[ci][0:dig_idx] + modified_channels[ci][dig_idx + 1:]
+        zero = _LEADING_ZERO.match(channel)
+        if zero:
+            modified_channels[ci] = zero[1] + channel[zero.end():]
 
     return modified_channels
 
@@ -117,56 +115,51 @@ def define_pairs(channels):
     channels = remove_utility_channels(channels)
     channels = channel_sort_list(channels)
 
-    channel_bases = []
+    # channel base and number, channels without number are not used
+    parsed = []
     for channel in channels:
-        channel_bases.append(''.join([x.strip() for x in channel if x.isalpha() or x == "'"]))
-
-    channel_nums = []
-    not_use_num = []
-    for i, channel in enumerate(channels):
-        num = ''.join([x.strip() for x in channel if x.isnumeric()])
+        num = _NOT_DIGITS.sub('', channel)
         if num != '':
-            channel_nums.append(int(''.join([x for x in channel if x.isnumeric()])))
-        else:
-            not_use_num.append(i)
-
-    if len(not_use_num) > 0:
-        ch_numbers = np.arange(len(channels))
-        ch_numbers = [x for x in ch_numbers if x not in not_use_num]
-        channel_bases = [channel_bases[k] for k in ch_numbers]
-        channels = [channels[k] for k in ch_numbers]
+            parsed.append((channel, _NOT_BASE.sub('', channel), int(num)))
 
     bipolar_pairs = []
     bipolar_names = []
 
-    for i, ch in enumerate(channels[:-1]):
-        channel_base = channel_bases[i]
-        ch_num = channel_nums[i]
-        if channel_bases[i + 1] == channel_base and channel_nums[i + 1] == ch_num + 1:
-            bipolar_pairs.append([ch, channels[i + 1]])
-            bipolar_names.append(ch + '_' + str(channel_nums[i + 1]))
+    for (ch, channel_base, ch_num), (next_ch, next_base, next_num) in zip(parsed[:-1], parsed[1:]):
+        if next_base == channel_base and next_num == ch_num + 1:
+            bipolar_pairs.append([ch, next_ch])
+            bipolar_names.append(ch + '_' + str(next_num))
 
     return bipolar_pairs, bipolar_names
 
 
-def bipolar_montage(data, channels, pairs):
+def bipolar_indices(channels, pairs):
     """
-    Function to define bipolar channels and compute signal of bipolar measurement
+    Function to find indices of unipolar channels forming bipolar pairs
 
-    :param data: Thirty-second signal segment
     :param channels: Unipolar channels
     :param pairs: Bipolar pairs
-    :return: Computed bipolar data
+    :return: Indices of first and second channels of bipolar pairs
     """
 
-    if len(data.T) != len(channels):
-        assert 'Number of channel names must be equal to number of signals.'
-
     ch_dict = dict(zip(channels, np.arange(len(channels))))
 
-    bi_data = np.zeros([len(data), len(pairs)], dtype='float64')
+    idx_a = np.array([ch_dict[pair[0]] for pair in pairs], dtype=int)
+    idx_b = np.array([ch_dict[pair[1]] for pair in pairs], dtype=int)
+
+    return idx_a, idx_b
+
+
+def bipolar_montage(data, pairs_idx):
+    """
+    Function to compute signal of bipolar measurement
+
+    :param data: Thirty-second signal segment
+    :param pairs_idx: Indices of unipolar channels forming bipolar pairs, see bipolar_indices
+    :return: Computed bipolar data
+    """
 
-    for i, pair in enumerate(pairs):
-        bi_data[:, i] = data[:, ch_dict[pair[0]]] - data[:, ch_dict[pair[1]]]
+    idx_a, idx_b = pairs_idx
 
-    return bi_data
+    # gather whole channels and keep them contiguous, resampling filters run along each channel
+    return (data.T[idx_a] - data.T[idx_b]).T
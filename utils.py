@@ -1,33 +1,65 @@
 import numpy as np
-from scipy.signal import lfilter
+from numba import njit, prange
+from scipy.signal import resample_poly
 from montage import bipolar_montage
 
-
-def read_signal(ms, time_start, window, overlap, channels, pairs):
+# fastmath flags without 'nnan'/'ninf' - flat or broken channels produce log(0) and NaN gaps,
+# these have to propagate to the features to be caught by the outlier detection
+FASTMATH = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+# anti-aliasing FIR filter of the factor-5 resampling stages
+HD5 = np.array([-0.000413312132792,   0.000384910656353,   0.000895384486596,   0.001426584098180,
+                 0.001572675788393,   0.000956099017099,  -0.000559378457343,  -0.002678217568221,
+                -0.004629975982837,  -0.005358589238386,  -0.003933117464092,  -0.000059710059922,
+                 0.005521319363883,   0.010983495478404,   0.013840996082966,   0.011817315106321,
+                 0.003905283425021,  -0.008768844009700,  -0.022682212400564,  -0.032498023687148,
+                -0.032456772047175,  -0.018225658085891,   0.011386634156651,   0.053456542440034,
+                 0.101168250947271,   0.145263694388270,   0.176384224234024,   0.187607302744229,
+                 0.176384224234024,   0.145263694388270,   0.101168250947271,   0.053456542440034,
+                 0.011386634156651,  -0.018225658085891,  -0.032456772047175,  -0.032498023687148,
+                -0.022682212400564,  -0.008768844009700,   0.003905283425021,   0.011817315106321,
+                 0.013840996082966,   0.010983495478404,   0.005521319363883,  -0.000059710059922,
+                -0.003933117464092,  -0.005358589238386,  -0.004629975982837,  -0.002678217568221,
+                -0.000559378457343,   0.000956099017099,   0.001572675788393,   0.001426584098180,
+                 0.000895384486596,   0.000384910656353,  -0.000413312132792])
+
+# Daubechies wavelet filters for the leaders decomposition
+WAVELET_LX = np.array([.22641898, .85394354, 1.02432694, .19576696, -.34265671, -.04560113,
+                       .10970265, -.0088268, -.01779187, .00471742793])
+WAVELET_H = np.flipud(WAVELET_LX) * (-1) ** np.arange(WAVELET_LX.shape[0])
+
+
+def read_signal(ms, time_start, window, overlap, channels, pairs_idx, fs, n_epochs=1):
     """
-    Function to read signal from MEF session and compute bipolar data
+    Function to read signal of consecutive epochs from MEF session at once and compute bipolar data
 
     :param ms: MEF session
     :param time_start: Signal segment start time
     :param window: Thirty-second window
     :param overlap: Overlapping part size
     :param channels: Unipolar channels
-    :param pairs: Bipolar pairs
-    :return: Computed bipolar data
+    :param pairs_idx: Indices of unipolar channels forming bipolar pairs
+    :param fs: Sampling rate
+    :param n_epochs: Number of consecutive epochs
+    :return: Computed bipolar data for each epoch
     """
 
     overlap_size = overlap * 1e6
-    window = window * 1e6
+    window_size = window * 1e6
 
     time_start = time_start - overlap_size
-    time_stop = time_start + window + 2 * overlap_size
+    time_stop = time_start + n_epochs * window_size + 2 * overlap_size
 
     uni_data = np.c_[ms.read_ts_channels_uutc(channels, [int(time_start), int(time_stop)])]
 
     # create bipolar
-    bi_data = bipolar_montage(uni_data.T, channels, pairs)
+    bi_data = bipolar_montage(uni_data.T, pairs_idx)
 
-    return bi_data
+    # split to epochs, each with its overlapping parts
+    step = round(window * fs)
+    length = step + 2 * round(overlap * fs)
+
+    return [bi_data[k * step:k * step + length] for k in range(n_epochs)]
 
 
 def change_sampling_rate(x, fs):
@@ -39,64 +71,29 @@ def change_sampling_rate(x, fs):
     :return: Resampled signal segment
     """
 
-    od5, od2, ou2 = 54, 26, 34
-
-    hd5 = np.array([-0.000413312132792,   0.000384910656353,   0.000895384486596,   0.001426584098180,
-                     0.001572675788393,   0.000956099017099,  -0.000559378457343,  -0.002678217568221,
-                    -0.004629975982837,  -0.005358589238386,  -0.003933117464092,  -0.000059710059922,
-                     0.005521319363883,   0.010983495478404,   0.013840996082966,   0.011817315106321,
-                     0.003905283425021,  -0.008768844009700,  -0.022682212400564,  -0.032498023687148,
-                    -0.032456772047175,  -0.018225658085891,   0.011386634156651,   0.053456542440034,
-                     0.101168250947271,   0.145263694388270,   0.176384224234024,   0.187607302744229,
-                     0.176384224234024,   0.145263694388270,   0.101168250947271,   0.053456542440034,
-                     0.011386634156651,  -0.018225658085891,  -0.032456772047175,  -0.032498023687148,
-                    -0.022682212400564,  -0.008768844009700,   0.003905283425021,   0.011817315106321,
-                     0.013840996082966,   0.010983495478404,   0.005521319363883,  -0.000059710059922,
-                    -0.003933117464092,  -0.005358589238386,  -0.004629975982837,  -0.002678217568221,
-                    -0.000559378457343,   0.000956099017099,   0.001572675788393,   0.001426584098180,
-                     0.000895384486596,   0.000384910656353,  -0.000413312132792])
-
     if fs == 2000:
-        z = np.zeros((od5 // 2, x.shape[1]))
-        x = lfilter(hd5, 1, np.concatenate([x, z]), axis=0)[od5 // 2:]
-        x = x[::5, :]
-
-        x = 4 * np.reshape(np.stack([x, np.zeros_like(x), np.zeros_like(x), np.zeros_like(x)]),
-                           (4 * x.shape[0], x.shape[1]), order='F')
-        x = lfilter(hd5, 1, np.concatenate([x, z]), axis=0)[od5 // 2:]
-        x = x[::5, :]
-
-        x = 4 * np.reshape(np.stack([x, np.zeros_like(x), np.zeros_like(x), np.zeros_like(x)]),
-                           (4 * x.shape[0], x.shape[1]), order='F')
-        x = lfilter(hd5, 1, np.concatenate([x, z]), axis=0)[od5 // 2:]
-        x = x[::5, :]
-
+        stages = [(1, 5), (4, 5), (4, 5)]
     elif fs == 5000:
-        z = np.zeros((od5 // 2, x.shape[1]))
-        x = lfilter(hd5, 1, np.concatenate([x, z]), axis=0)[od5 // 2:]
-        x = x[::5, :]
-
-        z = np.zeros((od5 // 2, x.shape[1]))
-        x = 2 * np.reshape(np.stack([x, np.zeros_like(x)]), (2 * x.shape[0], x.shape[1]), order='F')
-        x = lfilter(hd5, 1, np.concatenate([x, z]), axis=0)[od5 // 2:]
-        x = x[::5, :]
-
-        x = 4 * np.reshape(np.stack([x, np.zeros_like(x), np.zeros_like(x), np.zeros_like(x)]),
-                           (4 * x.shape[0], x.shape[1]), order='F')
-        x = lfilter(hd5, 1, np.concatenate([x, z]), axis=0)[od5 // 2:]
-        x = x[::5, :]
-
-        x = 4 * np.reshape(np.stack([x, np.zeros_like(x), np.zeros_like(x), np.zeros_like(x)]),
-                           (4 * x.shape[0], x.shape[1]), order='F')
-        x = lfilter(hd5, 1, np.concatenate([x, z]), axis=0)[od5 // 2:]
-        x = x[::5, :]
-
+        stages = [(1, 5), (2, 5), (4, 5), (4, 5)]
     else:
         raise ValueError
 
+    # polyphase filtering skips the zeros of upsampling and the samples dropped by downsampling
+    for up, down in stages:
+        x = resample_poly(x, up, down, axis=0, window=HD5)
+
     return x
 
 
+@njit(inline='always')
+def _maximum(a, b):
+    # NaN-propagating maximum of two scalars, same as np.maximum
+    if a != a or a > b:
+        return a
+    return b
+
+
+@njit('f8[::1](f8[::1])', fastmath=FASTMATH, cache=True)
 def compute_features(x):
     """
     Function to compute features for sleep stages classification
@@ -107,60 +104,254 @@ def compute_features(x):
 
     j = 8
     nd = 5
-    lx = np.array([.22641898, .85394354, 1.02432694, .19576696, -.34265671, -.04560113,
-                   .10970265, -.0088268, -.01779187, .00471742793])
+    nh = 2 * nd
 
-    h = np.flipud(lx) * (-1) ** np.arange(2 * nd)
+    x = x[:2 ** j * (x.shape[0] // 2 ** j)]
 
-    x = x[:2 ** j * int(np.floor(len(x) * 2 ** -j))]
-
-    laa = np.zeros((round(x.shape[0] / 2)))
+    laa = np.zeros(x.shape[0] // 2)
     c = np.zeros((3, j))
-    b = np.ones((j, 1))
-    mwc = np.zeros((3 * j, 1))
+    b = np.ones(j)
+    mwc = np.zeros(3 * j)
 
     for jj in range(j):
-        # compute the wavelet leaders
-        d = lfilter(h, 1, x, axis=0)
-        lea = d[::2]
-        x = lfilter(lx, 1, x, axis=0)
-        x = x[::2]
-
-        mm = np.abs(
-            lea[nd - 1 + int(np.ceil(256 / 2 ** (jj + 1))):-1 - int(max(np.ceil(256 / 2 ** (jj + 1)) - nd - 1, 0))])
-
-        mwc[jj] = np.log(np.mean(mm))
-        mwc[jj + j] = np.sum(mm ** 2)
-        mwc[jj + 2 * j] = np.log(np.std(mm))
-
-        lea = np.abs(np.hstack([0, lea.flatten(), 0]))
-        lea = np.maximum(np.maximum(lea[:-2], lea[1:-1]), lea[2:])
-        lea = np.maximum(lea, laa)
-        laa = np.maximum(lea[::2], lea[1::2])
+        # compute the wavelet leaders - both filters are FIR, evaluated only at the kept (even) samples
+        n = x.shape[0] // 2
+        lea = np.empty(n)
+        xa = np.empty(n)
+        for i in range(n):
+            t = 2 * i
+            sd = 0.
+            sa = 0.
+            for k in range(min(t + 1, nh)):
+                sd += WAVELET_H[k] * x[t - k]
+                sa += WAVELET_LX[k] * x[t - k]
+            lea[i] = sd
+            xa[i] = sa
+        x = xa
 
-        # get cumulants of ln leaders
         # transients discarding
-        lea = lea[nd - 1 + int(np.ceil(256 / 2 ** (jj + 1))):-1 - int(max(np.ceil(256 / 2 ** (jj + 1)) - nd - 1, 0))]
-
-        le = np.log(lea)
-        u1 = np.mean(le)
-        u2 = np.mean(le ** 2)
-        u3 = np.mean(le ** 3)
+        s = int(np.ceil(256 / 2 ** (jj + 1)))
+        lo = nd - 1 + s
+        hi = n - 1 - max(s - nd - 1, 0)
+        nj = hi - lo
+
+        s1 = 0.
+        s2 = 0.
+        for i in range(lo, hi):
+            a = abs(lea[i])
+            s1 += a
+            s2 += a * a
+        mean = s1 / nj
+        var = 0.
+        for i in range(lo, hi):
+            var += (abs(lea[i]) - mean) ** 2
+
+        mwc[jj] = np.log(mean)
+        mwc[jj + j] = s2
+        mwc[jj + 2 * j] = np.log(np.sqrt(var / nj))
+
+        lead = np.empty(n)
+        for i in range(n):
+            v = abs(lea[i])
+            if i > 0:
+                v = _maximum(v, abs(lea[i - 1]))
+            if i < n - 1:
+                v = _maximum(v, abs(lea[i + 1]))
+            lead[i] = _maximum(v, laa[i])
+        laa = np.empty(n // 2)
+        for i in range(n // 2):
+            laa[i] = _maximum(lead[2 * i], lead[2 * i + 1])
 
-        c[:, jj] = np.array([u1, u2 - u1 ** 2, u3 - 3 * u1 * u2 + 2 * u1 ** 3])
-        nj = lea.shape[0]
+        # get cumulants of ln leaders
+        u1 = 0.
+        u2 = 0.
+        u3 = 0.
+        for i in range(lo, hi):
+            le = np.log(lead[i])
+            u1 += le
+            u2 += le * le
+            u3 += le * le * le
+        u1 /= nj
+        u2 /= nj
+        u3 /= nj
+
+        c[0, jj] = u1
+        c[1, jj] = u2 - u1 ** 2
+        c[2, jj] = u3 - 3 * u1 * u2 + 2 * u1 ** 3
         b[jj] = nj
 
     sc = np.arange(1, 6, 1)
     c = c[:, sc]
     b = b[sc]
     v0 = np.sum(b)
-    v1 = np.dot(sc + 1, b)
-    v2 = np.dot((sc + 1) ** 2, b)
-    w = b.T * ((v0 * (sc + 1) - v1) / (v0 * v2 - v1 ** 2))
+    v1 = np.dot((sc + 1).astype(np.float64), b)
+    v2 = np.dot(((sc + 1) ** 2).astype(np.float64), b)
+    w = b * ((v0 * (sc + 1) - v1) / (v0 * v2 - v1 ** 2))
 
-    f = np.sum(np.log2(np.exp(1)) * w * c, axis=1)
-    f = np.concatenate([f, mwc.flatten()])
-    f = np.delete(f, np.array((4, 4 + j, 4 + 2 * j), dtype=int), axis=0)  # exclude the 64-128 Hz scale
+    f = np.empty(3 * j)
+    for r in range(3):
+        f[r] = np.log2(np.exp(1)) * np.sum(w * c[r])
+
+    # exclude the 64-128 Hz scale
+    k = 3
+    for jj in range(3 * j):
+        if jj % j != 1:
+            f[k] = mwc[jj]
+            k += 1
 
     return f
+
+
+@njit('f8[:, ::1](f8[:, :])', parallel=True, fastmath=FASTMATH, cache=True)
+def compute_epoch_features(x):
+    """
+    Function to compute features of all channels of a signal segment in parallel
+
+    :param x: Thirty-second signal segment (samples x channels)
+    :return: Computed features for signal segment (features x channels)
+    """
+
+    # channels x samples, so that the filters of every channel sweep contiguous memory
+    x = np.ascontiguousarray(x.T)
+    feature = np.empty((24, x.shape[0]))
+
+    for i in prange(x.shape[0]):
+        feature[:, i] = compute_features(x[i])
+
+    return feature
+
+
+@njit('f8[::1](f8[::1], i8)', cache=True)
+def _moving_average(x, k):
+    """
+    Function to compute moving average as running sum, edges are extended by the first and last value
+
+    :param x: Values
+    :param k: Window length
+    :return: Averaged values
+    """
+
+    n = x.shape[0]
+    left, right = k // 2, (k - 1) // 2
+    ma = np.empty(n)
+    if n == 0:
+        return ma
+
+    s = 0.
+    for i in range(-left, right + 1):
+        s += x[min(max(i, 0), n - 1)]
+    ma[0] = s / k
+    for i in range(1, n):
+        s += x[min(i + right, n - 1)] - x[max(i - left - 1, 0)]
+        ma[i] = s / k
+
+    return ma
+
+
+@njit('f8(f4[::1], b1[::1])', fastmath=FASTMATH, error_model='numpy', cache=True)
+def _preprocess_cell(f, night):
+    """
+    Function to remove outliers, smooth and normalize one feature of one channel in place
+
+    :param f: Feature values for all epochs
+    :param night: Night epochs
+    :return: Feature coordinate
+    """
+
+    # non-NaN epochs, all steps run on these only
+    idx = np.empty(f.shape[0], dtype=np.int64)
+    v = np.empty(f.shape[0])
+    n = 0
+    for i in range(f.shape[0]):
+        if not np.isnan(f[i]):
+            idx[n] = i
+            v[n] = f[i]
+            n += 1
+    if n == 0:
+        return 0.
+
+    # outlier detection
+    r = v[:n] - _moving_average(v[:n], 10)
+    k0, k1 = int(np.rint(0.25 * n)), min(int(np.rint(0.75 * n)), n - 1)
+    rp = np.partition(r, np.array([k0, k1]))
+    m0, m1 = rp[k0], rp[k1]
+    lo = m0 - 2.5 * (m1 - m0)
+    hi = m1 + 2.5 * (m1 - m0)
+
+    nk = 0
+    for i in range(n):
+        if lo <= r[i] <= hi:
+            idx[nk] = idx[i]
+            v[nk] = v[i]
+            nk += 1
+    idx = idx[:nk]
+
+    # smoothing
+    v = _moving_average(v[:nk], 3)
+
+    # normalizing
+    if nk < f.shape[0] or np.any(v != 0):
+        s1 = 0.
+        nn = 0
+        for i in range(nk):
+            if night[idx[i]]:
+                s1 += v[i]
+                nn += 1
+        mean = s1 / nn
+        s2 = 0.
+        for i in range(nk):
+            if night[idx[i]]:
+                s2 += (v[i] - mean) ** 2
+        std = np.sqrt(s2 / nn)
+        for i in range(nk):
+            v[i] = (v[i] - mean) / std
+
+    # get features coordinates
+    f[:] = np.nan
+    for i in range(nk):
+        f[idx[i]] = v[i]
+    v = v[~np.isnan(v)]
+    fm = _moving_average(v, 10)
+
+    # ratio of squared norms, one square root
+    denom2 = np.dot(v, v)
+    if denom2:
+        return np.sqrt(np.dot(fm, fm) / denom2)
+
+    return 0.
+
+
+@njit('f8[:, ::1](f4[:, :, ::1], b1[::1])', parallel=True, cache=True)
+def _preprocess_cells(f, night):
+    """
+    Function to preprocess all features of all channels in place
+
+    :param f: Computed features (channels x features x epochs)
+    :param night: Night epochs
+    :return: Features coordinates (channels x features)
+    """
+
+    featfeat = np.zeros((f.shape[0], f.shape[1]))
+
+    for nch in prange(f.shape[0]):
+        for nf in range(f.shape[1]):
+            featfeat[nch, nf] = _preprocess_cell(f[nch, nf], night)
+
+    return featfeat
+
+
+def preprocess_features(feature, night):
+    """
+    Function to remove outliers, smooth and normalize features in place
+
+    :param feature: Computed features (channels x features x epochs), C-contiguous
+    :param night: Night epochs
+    :return: Features coordinates (channels x features)
+    """
+
+    # epochs with any non-finite feature are removed from all features of the channel
+    bad = ~np.all(np.isfinite(feature), axis=1)
+    feature.transpose((0, 2, 1))[bad] = np.nan
+
+    # each channel and feature is processed along contiguous epochs
+    return _preprocess_cells(np.asarray(feature), night[:, 0].astype(bool))